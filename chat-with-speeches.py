@@ -1,8 +1,10 @@
 import json
 import os
 import sqlite3
+from functools import lru_cache
 
 import dotenv
+import httpx
 import sqlite_vss
 from openai import OpenAI
 
@@ -10,7 +12,36 @@ from openai import OpenAI
 dotenv.load_dotenv()
 
 # Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Each question embeds the query and then asks for an answer; both calls reuse
+# the same keep-alive connection.
+http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=300),
+    timeout=120.0,
+)
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client)
+
+# SQLite 3.41+ passes LIMIT through to vss_search; older versions need the
+# number of neighbours wrapped in vss_search_params.
+if sqlite3.sqlite_version_info >= (3, 41, 0):
+    KNN_CONDITION = "vss_search(vector, ?) LIMIT ?"
+else:
+    KNN_CONDITION = "vss_search(vector, vss_search_params(?, ?))"
+
+# Let the vss0 index find the nearest neighbours, then join back to the main
+# speeches table to get the full text and metadata
+SEARCH_QUERY = f"""
+WITH matches AS (
+    SELECT rowid, distance
+    FROM speeches_vss
+    WHERE {KNN_CONDITION}
+)
+SELECT s.rowid, s.country, s.session, s.year, s.speaker, s.text,
+       m.distance
+FROM matches m
+JOIN speeches s ON s.rowid = m.rowid
+ORDER BY m.distance ASC
+"""
 
 
 def setup_db_connection():
@@ -44,9 +75,10 @@ def setup_vector_tables(conn):
         if not cursor.fetchone():
             print("Creating vector search table speeches_vss...")
             # Get available functions to diagnose
-            cursor.execute("SELECT * FROM sqlite_master WHERE type='function'")
-            functions = cursor.fetchall()
-            print(f"Available SQLite functions: {[f[1] for f in functions]}")
+            if os.getenv("DEBUG_VSS"):
+                cursor.execute("SELECT * FROM sqlite_master WHERE type='function'")
+                functions = cursor.fetchall()
+                print(f"Available SQLite functions: {[f[1] for f in functions]}")
 
             # Create the vector search table
             cursor.execute("""
@@ -56,26 +88,23 @@ def setup_vector_tables(conn):
             );
             """)
 
-            # Get all speeches without embeddings
+            # Get all speeches
             cursor.execute("SELECT rowid, text FROM speeches")
             speeches = cursor.fetchall()
 
             print(f"Generating embeddings for {len(speeches)} speeches...")
+            payload = []
+            # The table was just created, so none of these have an embedding yet
             for rowid, text in speeches:
-                # Check if embedding already exists
-                cursor.execute("SELECT rowid FROM speeches_vss WHERE rowid=?", (rowid,))
-                if cursor.fetchone():
-                    continue
-
-                # Generate embedding and store it
+                # Generate embedding and queue it for insertion
                 embedding = generate_embedding(text)
                 if embedding:
-                    embedding_json = json.dumps(embedding)
-                    cursor.execute(
-                        "INSERT INTO speeches_vss (rowid, vector) VALUES (?, ?)",
-                        (rowid, embedding_json),
-                    )
+                    payload.append((rowid, json.dumps(embedding)))
 
+            # Store all embeddings with one prepared statement
+            cursor.executemany(
+                "INSERT INTO speeches_vss (rowid, vector) VALUES (?, ?)", payload
+            )
             conn.commit()
             print("Vector search table setup complete.")
 
@@ -104,6 +133,22 @@ def generate_embedding(text):
         return None
 
 
+@lru_cache(maxsize=1024)
+def _cached_query_embedding(text):
+    """Embed a query once per session; repeated questions reuse the result."""
+    response = client.embeddings.create(input=text, model="text-embedding-3-small")
+    return tuple(response.data[0].embedding)
+
+
+def generate_query_embedding(text):
+    """Generate an embedding for a user query, cached in memory."""
+    try:
+        return list(_cached_query_embedding(text))
+    except Exception as e:
+        print(f"Error generating embedding: {e}")
+        return None
+
+
 def search_similar_speeches(conn, query_embedding, limit=2):
     """Search for speeches similar to the query embedding."""
     try:
@@ -113,47 +158,9 @@ def search_similar_speeches(conn, query_embedding, limit=2):
         # Execute vector similarity search
         cursor = conn.cursor()
 
-        # Try to get available vector functions
-        try:
-            cursor.execute(
-                "SELECT name FROM sqlite_master WHERE type='function' AND name LIKE '%vss%' OR name LIKE '%vector%'"
-            )
-            functions = cursor.fetchall()
-            print(f"Available vector functions: {[f[0] for f in functions]}")
-        except:
-            pass
-
-        # Join with the main speeches table to get the full text and metadata
-        # Use vector_distance instead of vss_distance
-        query = """
-        SELECT s.rowid, s.country, s.session, s.year, s.speaker, s.text, 
-               vector_distance(v.vector, ?) as distance
-        FROM speeches s
-        JOIN speeches_vss v ON s.rowid = v.rowid
-        ORDER BY distance ASC
-        LIMIT ?
-        """
-
-        try:
-            cursor.execute(query, (query_embedding_str, limit))
-            results = cursor.fetchall()
-            return results
-        except sqlite3.OperationalError as e:
-            if "no such function" in str(e):
-                # Try alternative function name
-                alternative_query = """
-                SELECT s.rowid, s.country, s.session, s.year, s.speaker, s.text, 
-                       vss_search(v.vector, ?) as distance
-                FROM speeches s
-                JOIN speeches_vss v ON s.rowid = v.rowid
-                ORDER BY distance ASC
-                LIMIT ?
-                """
-                cursor.execute(alternative_query, (query_embedding_str, limit))
-                results = cursor.fetchall()
-                return results
-            else:
-                raise e
+        cursor.execute(SEARCH_QUERY, (query_embedding_str, limit))
+        results = cursor.fetchall()
+        return results
 
     except Exception as e:
         print(f"Error searching similar speeches: {e}")
@@ -230,7 +237,7 @@ def chat_loop():
             print("Processing your question...")
 
             # Generate embedding for the query
-            query_embedding = generate_embedding(user_input)
+            query_embedding = generate_query_embedding(user_input)
             if not query_embedding:
                 print("Failed to generate embedding for your question.")
                 continue
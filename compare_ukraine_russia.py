@@ -1,4 +1,3 @@
-import json
 import os
 import sqlite3
 from collections import defaultdict
@@ -38,133 +37,61 @@ def setup_db_connection():
         return None
 
 
-def get_ukraine_russia_speeches(conn):
-    """Get speeches from Ukraine and Russia/USSR."""
+def compare_speeches_by_year(conn):
+    """Compare speeches between Ukraine and Russia for each year."""
     cursor = conn.cursor()
 
-    # Query to get all speeches from Ukraine and Russia/USSR with their embeddings
+    # Pair every Ukraine speech with every Russia/USSR speech of the same year
+    # and let sqlite-vss compute the similarity, so the vectors never leave SQLite.
+    # vss0 cannot look rows up by rowid, so its vectors are read in a single
+    # scan into a materialized CTE which is then self-joined.
     query = """
-    SELECT s.rowid, s.country, s.country_name, s.session, s.year, 
-           COALESCE(s.speaker, 'Unknown') as speaker, 
-           v.vector
-    FROM speeches s
-    JOIN speeches_vss v ON s.rowid = v.rowid
-    WHERE s.country_name IN ('Ukraine', 'Russia', 'USSR', 'Russian Federation', 'Soviet Union')
-    ORDER BY s.year
+    WITH grouped AS (
+        SELECT s.rowid, s.year, s.session,
+               COALESCE(s.speaker, 'Unknown') as speaker,
+               CASE WHEN s.country_name = 'Ukraine' THEN 'Ukraine'
+                    ELSE 'Russia/USSR' END AS country_group
+        FROM speeches s
+        WHERE s.country_name IN ('Ukraine', 'Russia', 'USSR', 'Russian Federation', 'Soviet Union')
+    ),
+    vecs AS MATERIALIZED (
+        SELECT g.*, v.vector
+        FROM grouped g
+        JOIN speeches_vss v ON v.rowid = g.rowid
+    )
+    SELECT u.year,
+           vss_cosine_similarity(u.vector, r.vector) AS similarity,
+           u.speaker, r.speaker, u.session, r.session
+    FROM vecs u
+    JOIN vecs r ON r.year = u.year AND r.country_group = 'Russia/USSR'
+    WHERE u.country_group = 'Ukraine'
+    ORDER BY u.year, u.rowid, r.rowid
     """
 
     try:
         cursor.execute(query)
-        rows = cursor.fetchall()
-
-        if not rows:
-            print("No speeches found for Ukraine or Russia/USSR.")
-            return {}
-
-        print(f"Found {len(rows)} speeches from Ukraine and Russia/USSR.")
-
-        embeddings_dict = {}
-        for row in rows:
-            rowid, country, country_name, session, year, speaker, vector_str = row
-            metadata = {
-                "country": country,
-                "country_name": country_name,
-                "session": session,
-                "year": year,
-                "speaker": speaker,
-            }
-
-            # Try different methods to parse the vector data
-            try:
-                # First try to parse as JSON string
-                embedding = json.loads(vector_str)
-            except (json.JSONDecodeError, TypeError, UnicodeDecodeError):
-                try:
-                    # If that fails, try to interpret as binary data
-                    if isinstance(vector_str, bytes):
-                        # Attempt to convert binary to string representation
-                        import struct
-
-                        # Assuming it's stored as array of 32-bit floats
-                        vector_size = len(vector_str) // 4  # 4 bytes per float
-                        embedding = list(struct.unpack(f"{vector_size}f", vector_str))
-                    else:
-                        print(
-                            f"Unknown vector format for rowid {rowid}: {type(vector_str)}"
-                        )
-                        continue
-                except Exception as inner_e:
-                    print(f"Could not parse vector for rowid {rowid}: {inner_e}")
-                    continue
-
-            embeddings_dict[rowid] = (metadata, embedding)
-
-        return embeddings_dict
+
+        results = []
+        for row in cursor:
+            year, similarity, u_speaker, r_speaker, u_session, r_session = row
+            results.append(
+                {
+                    "year": year,
+                    "similarity": similarity,
+                    "ukraine_speaker": u_speaker,
+                    "russia_speaker": r_speaker,
+                    "ukraine_session": u_session,
+                    "russia_session": r_session,
+                }
+            )
+
+        return results
     except Exception as e:
-        print(f"Error retrieving speeches: {e}")
+        print(f"Error comparing speeches: {e}")
         import traceback
 
         traceback.print_exc()
-        return {}
-
-
-def compute_cosine_similarity(v1, v2):
-    """Compute cosine similarity between two vectors."""
-    dot_product = sum(a * b for a, b in zip(v1, v2))
-    norm_v1 = sum(a * a for a in v1) ** 0.5
-    norm_v2 = sum(b * b for b in v2) ** 0.5
-
-    if norm_v1 == 0 or norm_v2 == 0:
-        return 0
-
-    return dot_product / (norm_v1 * norm_v2)
-
-
-def compare_speeches_by_year(embeddings_dict):
-    """Compare speeches between Ukraine and Russia for each year."""
-    # Group speeches by year and country
-    speeches_by_year_country = defaultdict(lambda: defaultdict(list))
-
-    for rowid, (metadata, embedding) in embeddings_dict.items():
-        year = metadata["year"]
-        country_name = metadata["country_name"]
-
-        # Group Russia, USSR, Russian Federation, Soviet Union together
-        if country_name in ["Russia", "USSR", "Russian Federation", "Soviet Union"]:
-            country_group = "Russia/USSR"
-        else:
-            country_group = "Ukraine"
-
-        speeches_by_year_country[year][country_group].append(
-            (rowid, metadata, embedding)
-        )
-
-    # Compare speeches for each year where both countries have speeches
-    results = []
-    for year in sorted(speeches_by_year_country.keys()):
-        countries_data = speeches_by_year_country[year]
-
-        if "Russia/USSR" in countries_data and "Ukraine" in countries_data:
-            russia_speeches = countries_data["Russia/USSR"]
-            ukraine_speeches = countries_data["Ukraine"]
-
-            # Compare each Ukraine speech with each Russia speech for this year
-            for u_rowid, u_metadata, u_embedding in ukraine_speeches:
-                for r_rowid, r_metadata, r_embedding in russia_speeches:
-                    similarity = compute_cosine_similarity(u_embedding, r_embedding)
-
-                    results.append(
-                        {
-                            "year": year,
-                            "similarity": similarity,
-                            "ukraine_speaker": u_metadata["speaker"],
-                            "russia_speaker": r_metadata["speaker"],
-                            "ukraine_session": u_metadata["session"],
-                            "russia_session": r_metadata["session"],
-                        }
-                    )
-
-    return results
+        return []
 
 
 def main():
@@ -173,15 +100,8 @@ def main():
         print("Could not connect to database. Exiting.")
         return
 
-    # Get Ukraine and Russia speeches
-    embeddings_dict = get_ukraine_russia_speeches(conn)
-
-    if not embeddings_dict:
-        print("No speech embeddings found.")
-        return
-
-    # Compare speeches by year
-    results = compare_speeches_by_year(embeddings_dict)
+    # Compare Ukraine and Russia speeches by year
+    results = compare_speeches_by_year(conn)
 
     if not results:
         print("No years with speeches from both Ukraine and Russia/USSR.")
@@ -1,14 +1,47 @@
+import hashlib
 import json
 import os
 import sqlite3
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 
+import httpx
+import numpy as np
 import sqlite_vss
-from openai import OpenAI
+import tiktoken
+from openai import OpenAI, RateLimitError
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# HTTP/2 keep-alive connections shared by the embedding worker threads.
+http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=300),
+    timeout=120.0,
+)
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client)
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Maximum number of texts sent in a single embeddings request.
+BATCH_SIZE = 100
+# Keep each request well below the API's per-request token limit.
+MAX_BATCH_TOKENS = 250_000
+# Per-input token limit of the embedding model.
+MAX_INPUT_TOKENS = 8191
+# Number of embedding requests in flight at the same time.
+MAX_WORKERS = 8
+# Tokens in flight across those requests, to keep bursts well under the
+# account's tokens-per-minute limit.
+MAX_INFLIGHT_TOKENS = 500_000
+# Attempts per batch when the API responds with a rate limit error.
+MAX_RETRIES = 5
+
+encoding = tiktoken.encoding_for_model(EMBEDDING_MODEL)
 
 # Open your database connection.
 conn = sqlite3.connect("un_speeches.db")
+# WAL with synchronous=NORMAL avoids an fsync on every commit.
+conn.execute("PRAGMA journal_mode=WAL")
+conn.execute("PRAGMA synchronous=NORMAL")
 c = conn.cursor()
 
 # Load the vector-index extension.
@@ -25,34 +58,159 @@ except Exception as e:
 # Create the virtual table for vector embeddings.
 # Here we assume the model returns vectors of dimension 1536.
 c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS speeches_vss USING vss0(vector(1536));")
+
+# Also keep an int8-quantized copy with a per-vector scale, a quarter of the size.
+c.execute(
+    "CREATE TABLE IF NOT EXISTS speeches_quant(rowid INTEGER PRIMARY KEY, q BLOB, scale REAL)"
+)
 conn.commit()
 
+# Fetch the rowids that already have an embedding once, instead of per row.
+existing = {r[0] for r in c.execute("SELECT rowid FROM speeches_vss")}
+
 # Retrieve rows from the main table (including the implicit rowid).
 c.execute("SELECT rowid, country, session, year, text FROM speeches LIMIT 3000")
 rows = c.fetchall()
 
+
+def fetch_embeddings(batch):
+    """Embed a batch of texts with one API call, backing off on rate limits."""
+    for attempt in range(MAX_RETRIES):
+        try:
+            response = client.embeddings.create(input=batch, model=EMBEDDING_MODEL)
+            return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+        except RateLimitError:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(2**attempt)
+
+
+def quantize_embedding(embedding):
+    """Quantize an embedding to int8 codes and the scale to restore it."""
+    embedding = np.asarray(embedding, dtype=np.float32)
+    scale = float(np.max(np.abs(embedding))) / 127 or 1.0
+    q = np.clip(np.round(embedding / scale), -127, 127).astype(np.int8)
+    return q.tobytes(), scale
+
+
+def store_embeddings(batch_ids, embeddings):
+    """Store a batch of embeddings in a single transaction."""
+    with conn:
+        c.executemany(
+            "INSERT INTO speeches_vss(rowid, vector) VALUES (?, ?)",
+            [(rid, json.dumps(emb)) for rid, emb in zip(batch_ids, embeddings)],
+        )
+        c.executemany(
+            "INSERT OR REPLACE INTO speeches_quant(rowid, q, scale) VALUES (?, ?, ?)",
+            [
+                (rid, *quantize_embedding(emb))
+                for rid, emb in zip(batch_ids, embeddings)
+            ],
+        )
+
+
+# Backfill the quantized copy for speeches embedded before that table existed.
+# vss0 returns each vector as a raw float32 BLOB.
+unquantized = c.execute(
+    """
+    SELECT rowid, vector
+    FROM speeches_vss
+    WHERE rowid NOT IN (SELECT rowid FROM speeches_quant)
+    """
+).fetchall()
+if unquantized:
+    with conn:
+        c.executemany(
+            "INSERT INTO speeches_quant(rowid, q, scale) VALUES (?, ?, ?)",
+            [
+                (rid, *quantize_embedding(np.frombuffer(emb, dtype=np.float32)))
+                for rid, emb in unquantized
+            ],
+        )
+    print(f"Backfilled quantized embeddings for {len(unquantized)} speeches.")
+
+# Speeches with identical (whitespace-normalized) text share one embedding.
+seen: dict[str, int] = {}  # text hash -> rowid whose embedding is requested
+# rowid -> rowids with the same text
+duplicates: defaultdict[int, list[int]] = defaultdict(list)
+
+batches = []
+batch: list[str] = []
+batch_ids: list[int] = []
+batch_tokens = 0
+
 for row in rows:
     rowid, country, session, year, text = row
-    print(f"Processing rowid {rowid} ({country}, {session}, {year})...")
-    # Check if an embedding already exists for this rowid.
-    c.execute("SELECT rowid FROM speeches_vss WHERE rowid = ?", (rowid,))
-    if c.fetchone():
+    if rowid in existing:
         print(f"Embedding for rowid {rowid} exists; skipping.")
         continue
-    try:
-        response = client.embeddings.create(input=text, model="text-embedding-3-small")
-        embedding = response.data[0].embedding  # this is a list
-        embedding_str = json.dumps(embedding)  # convert list to JSON string
-        print(f"Received embedding for rowid {rowid}: {embedding_str[:60]}...")
 
-        c.execute(
-            "INSERT INTO speeches_vss(rowid, vector) VALUES (?, ?)",
-            (rowid, embedding_str),
-        )
-        conn.commit()
-        print(f"Inserted embedding for rowid {rowid}.")
-    except Exception as e:
-        print(f"Error for rowid {rowid}: {e}")
+    text_hash = hashlib.sha256(" ".join(text.split()).encode()).hexdigest()
+    if text_hash in seen:
+        print(f"Rowid {rowid} has the same text as rowid {seen[text_hash]}.")
+        duplicates[seen[text_hash]].append(rowid)
+        continue
+
+    n_tokens = len(encoding.encode(text, disallowed_special=()))
+    if n_tokens > MAX_INPUT_TOKENS:
+        print(f"Error for rowid {rowid}: text has {n_tokens} tokens; skipping.")
+        continue
+
+    # Start a new batch before the current one exceeds the size or token budget.
+    if batch and (
+        len(batch) >= BATCH_SIZE or batch_tokens + n_tokens > MAX_BATCH_TOKENS
+    ):
+        batches.append((batch_ids, batch, batch_tokens))
+        batch, batch_ids, batch_tokens = [], [], 0
+
+    print(f"Queued rowid {rowid} ({country}, {session}, {year})...")
+    seen[text_hash] = rowid
+    batch.append(text)
+    batch_ids.append(rowid)
+    batch_tokens += n_tokens
+
+if batch:
+    batches.append((batch_ids, batch, batch_tokens))
+
+# Embedding requests are network-bound, so run them on a thread pool. Inserts
+# stay on the main thread, which owns the SQLite connection. A batch that
+# fails is not stored, so its speeches are picked up again on the next run.
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    # Each running request with its rowids and token count
+    pending: dict[Future, tuple[list[int], int]] = {}
+    inflight_tokens = 0
+    next_batch = 0
+    while next_batch < len(batches) or pending:
+        # Submit batches while the token budget allows, but always keep one going
+        while next_batch < len(batches) and len(pending) < MAX_WORKERS:
+            batch_ids, batch, batch_tokens = batches[next_batch]
+            if pending and inflight_tokens + batch_tokens > MAX_INFLIGHT_TOKENS:
+                break
+            future = executor.submit(fetch_embeddings, batch)
+            pending[future] = (batch_ids, batch_tokens)
+            inflight_tokens += batch_tokens
+            next_batch += 1
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            batch_ids, batch_tokens = pending.pop(future)
+            inflight_tokens -= batch_tokens
+            try:
+                embeddings = future.result()
+                print(f"Received {len(embeddings)} embeddings.")
+                # Reuse each embedding for the speeches that share its text
+                rowids, rowid_embeddings = [], []
+                for rid, emb in zip(batch_ids, embeddings):
+                    for r in [rid] + duplicates[rid]:
+                        rowids.append(r)
+                        rowid_embeddings.append(emb)
+                store_embeddings(rowids, rowid_embeddings)
+                print(f"Inserted embeddings for rowids {batch_ids[0]}-{batch_ids[-1]}.")
+            except Exception as e:
+                print(
+                    f"Error for batch with rowids {batch_ids[0]}-{batch_ids[-1]}: {e}; "
+                    "it will be retried on the next run."
+                )
 
 conn.close()
 print("Done.")
@@ -1,6 +1,9 @@
+import hashlib
 import json
+import os
 import sqlite3
 
+import numpy as np
 import sqlite_vss
 from dotenv import load_dotenv
 
@@ -13,11 +16,16 @@ load_dotenv()
 # Load the vector-index extension.
 print(sqlite_vss.vss_loadable_path())
 
+DB_PATH = "un_speeches.db"
+
+# Number of rows fetched from SQLite at a time when reading embeddings
+FETCH_SIZE = 500
+
 
 def setup_db_connection():
     """Set up the database connection."""
     try:
-        conn = sqlite3.connect("un_speeches.db")
+        conn = sqlite3.connect(DB_PATH)
 
         # Load the vector-index extension
         conn.enable_load_extension(True)
@@ -38,60 +46,87 @@ def setup_db_connection():
         return None
 
 
-def get_speech_embeddings(conn, limit=None):
-    """Get speech embeddings from the database."""
+def normalize_embedding(embedding):
+    """Scale an embedding to unit length so cosine similarity is a dot product."""
+    embedding = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    # Zero vectors stay zero, so their similarity with anything is 0
+    return embedding / norm if norm else embedding
+
+
+def get_speech_embeddings(conn, limit=None, quantized=False):
+    """Get speech embeddings from the database as normalized float32 arrays.
+
+    With quantized=True the int8 copies in speeches_quant are read instead,
+    which moves a quarter of the bytes out of SQLite.
+    """
     cursor = conn.cursor()
 
     limit_clause = f"LIMIT {limit}" if limit else ""
 
+    if quantized:
+        # Only speeches with a quantized copy are read; say so when that is a subset
+        try:
+            n_quant, n_vss = cursor.execute(
+                "SELECT (SELECT COUNT(*) FROM speeches_quant), "
+                "(SELECT COUNT(*) FROM speeches_vss)"
+            ).fetchone()
+        except sqlite3.OperationalError as e:
+            print(f"Could not read quantized embeddings: {e}")
+            return {}
+        if n_quant != n_vss:
+            print(
+                f"Warning: {n_quant} of {n_vss} embedded speeches have a quantized copy; "
+                "run semantic-RAG.py to backfill the rest."
+            )
+        vector_columns = "q.q AS vector, q.scale"
+        join_clause = "JOIN speeches_quant q ON s.rowid = q.rowid"
+    else:
+        vector_columns = "v.vector AS vector, NULL AS scale"
+        join_clause = "JOIN speeches_vss v ON s.rowid = v.rowid"
+
     query = f"""
     SELECT s.rowid, s.country, s.country_name, s.session, s.year, 
            COALESCE(s.speaker, 'Unknown') as speaker, 
-           v.vector
+           {vector_columns}
     FROM speeches s
-    JOIN speeches_vss v ON s.rowid = v.rowid
+    {join_clause}
     {limit_clause}
     """
 
     try:
         cursor.execute(query)
-        rows = cursor.fetchall()
 
         embeddings_dict = {}
-        for row in rows:
-            rowid, country, country_name, session, year, speaker, vector_str = row
-            metadata = {
-                "country": country,
-                "country_name": country_name,
-                "session": session,
-                "year": year,
-                "speaker": speaker,
-            }
-
-            # Try different methods to parse the vector data
-            try:
-                # First try to parse as JSON string
-                embedding = json.loads(vector_str)
-            except (json.JSONDecodeError, TypeError, UnicodeDecodeError):
+        # Stream rows in chunks instead of materializing every vector at once
+        for rows in iter(lambda: cursor.fetchmany(FETCH_SIZE), []):
+            for row in rows:
+                rowid, country, country_name, session, year, speaker = row[:6]
+                vector, scale = row[6:]
+                metadata = {
+                    "country": country,
+                    "country_name": country_name,
+                    "session": session,
+                    "year": year,
+                    "speaker": speaker,
+                }
+
                 try:
-                    # If that fails, try to interpret as binary data
-                    if isinstance(vector_str, bytes):
-                        # Attempt to convert binary to string representation
-                        import struct
-
-                        # Assuming it's stored as array of 32-bit floats
-                        vector_size = len(vector_str) // 4  # 4 bytes per float
-                        embedding = list(struct.unpack(f"{vector_size}f", vector_str))
+                    if scale is not None:
+                        # int8 codes with a per-vector scale
+                        codes = np.frombuffer(vector, dtype=np.int8)
+                        embedding = codes * np.float32(scale)
+                    elif isinstance(vector, bytes):
+                        # vss0 returns vectors as raw float32 BLOBs
+                        embedding = np.frombuffer(vector, dtype=np.float32)
                     else:
-                        print(
-                            f"Unknown vector format for rowid {rowid}: {type(vector_str)}"
-                        )
-                        continue
-                except Exception as inner_e:
-                    print(f"Could not parse vector for rowid {rowid}: {inner_e}")
+                        embedding = np.array(json.loads(vector), dtype=np.float32)
+                except (json.JSONDecodeError, TypeError, ValueError) as e:
+                    # Skip just this row, e.g. a truncated BLOB
+                    print(f"Could not parse vector for rowid {rowid}: {e}")
                     continue
 
-            embeddings_dict[rowid] = (metadata, embedding)
+                embeddings_dict[rowid] = (metadata, normalize_embedding(embedding))
 
         print(f"Retrieved {len(embeddings_dict)} speech embeddings")
         return embeddings_dict
@@ -103,21 +138,39 @@ def get_speech_embeddings(conn, limit=None):
         return {}
 
 
-def compute_cosine_similarity(v1, v2):
-    """Compute cosine similarity between two vectors."""
-    dot_product = sum(a * b for a, b in zip(v1, v2))
-    norm_v1 = sum(a * a for a in v1) ** 0.5
-    norm_v2 = sum(b * b for b in v2) ** 0.5
+def compute_similarity_matrix(embeddings_dict):
+    """Compute the cosine similarity between all pairs of normalized embeddings."""
+    matrix = np.stack([embedding for _, embedding in embeddings_dict.values()])
+    return matrix @ matrix.T
+
 
-    if norm_v1 == 0 or norm_v2 == 0:
-        return 0
+def get_similarity_matrix(embeddings_dict, quantized=False):
+    """Load the similarity matrix from the on-disk cache, computing it on a miss."""
+    # The matrix rows follow the order of the speeches, so key on that order,
+    # and on the database version so a changed database is never served stale
+    rowids = np.fromiter(embeddings_dict.keys(), dtype=np.int64)
+    stat = os.stat(DB_PATH)
+    db_version = f"{os.path.abspath(DB_PATH)}:{stat.st_size}:{stat.st_mtime_ns}"
+    fingerprint = hashlib.sha256(
+        db_version.encode() + rowids.tobytes() + bytes([quantized])
+    ).hexdigest()
+    path = f"sim_{fingerprint[:16]}.npy"
 
-    return dot_product / (norm_v1 * norm_v2)
+    if os.path.exists(path):
+        print(f"Using cached similarity matrix {path}")
+        return np.load(path, mmap_mode="r")
 
+    similarities = compute_similarity_matrix(embeddings_dict)
+    np.save(path, similarities)
+    return similarities
 
-def find_similar_speeches(embeddings_dict, threshold=0.8):
+
+def find_similar_speeches(embeddings_dict, threshold=0.8, similarities=None):
     """Find groups of similar speeches based on cosine similarity."""
     speech_ids = list(embeddings_dict.keys())
+    if similarities is None:
+        similarities = compute_similarity_matrix(embeddings_dict)
+
     similar_groups = []
 
     # Track processed speeches to avoid duplicates
@@ -127,23 +180,26 @@ def find_similar_speeches(embeddings_dict, threshold=0.8):
         if id1 in processed:
             continue
 
-        metadata1, embedding1 = embeddings_dict[id1]
-
-        # Find all speeches similar to this one
-        similar_speeches = []
-        for id2 in speech_ids[i + 1 :]:
-            metadata2, embedding2 = embeddings_dict[id2]
-            similarity = compute_cosine_similarity(embedding1, embedding2)
+        # Only compare with later speeches; the row slice is a view, not a copy
+        similar_indices = np.flatnonzero(similarities[i, i + 1 :] >= threshold) + i + 1
+        if not similar_indices.size:
+            continue
 
-            if similarity >= threshold:
-                similar_speeches.append((id2, similarity, metadata2))
+        metadata1, _ = embeddings_dict[id1]
+        similar_speeches = [
+            (
+                speech_ids[j],
+                float(similarities[i, j]),
+                embeddings_dict[speech_ids[j]][0],
+            )
+            for j in similar_indices
+        ]
 
-        # If we found similar speeches, create a group
-        if similar_speeches:
-            group = [(id1, 1.0, metadata1)] + similar_speeches
-            similar_groups.append(group)
-            processed.add(id1)
-            processed.update(id2 for id2, _, _ in similar_speeches)
+        # Create a group of this speech and its similar speeches
+        group = [(id1, 1.0, metadata1)] + similar_speeches
+        similar_groups.append(group)
+        processed.add(id1)
+        processed.update(id2 for id2, _, _ in similar_speeches)
 
     return similar_groups
 
@@ -158,7 +214,10 @@ def main():
     limit = int(
         input("Enter maximum number of speeches to analyze (or 0 for all): ") or "100"
     )
-    embeddings_dict = get_speech_embeddings(conn, limit if limit > 0 else None)
+    quantized = input("Use int8-quantized embeddings? (y/N): ").lower() == "y"
+    embeddings_dict = get_speech_embeddings(
+        conn, limit if limit > 0 else None, quantized
+    )
 
     if not embeddings_dict:
         print("No speech embeddings found.")
@@ -168,7 +227,10 @@ def main():
     similarity_threshold = float(
         input("Enter similarity threshold (0.0-1.0): ") or "0.8"
     )
-    similar_groups = find_similar_speeches(embeddings_dict, similarity_threshold)
+    similarities = get_similarity_matrix(embeddings_dict, quantized)
+    similar_groups = find_similar_speeches(
+        embeddings_dict, similarity_threshold, similarities
+    )
 
     # Display results
     print(f"\nFound {len(similar_groups)} groups of similar speeches:")
@@ -1,16 +1,50 @@
+import hashlib
 import os
 import re
 import sqlite3
+from functools import lru_cache
 
+import httpx
 from dotenv import load_dotenv
 from openai import OpenAI
 
 load_dotenv()
 
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Opened by warm_up_client() and reused by every model call in the agent loop.
+http_client = httpx.Client(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=8, max_connections=16),
+    timeout=60.0,
+)
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client)
 
-conn = sqlite3.connect("un_speeches.db")
+# The script only reads, so keep pages memory-resident and refuse writes
+READ_PRAGMAS = """
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=1073741824;
+PRAGMA cache_size=-262144;
+PRAGMA query_only=1;
+"""
+
+DB_PATH = "un_speeches.db"
+SCHEMA_CACHE_DIR = os.path.expanduser("~/.cache/sql-rag")
+
+conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+conn.executescript(READ_PRAGMAS)
+
+# Exploratory turns use the cheaper model; final answers come from the larger one
+EXPLORE_MODEL = "gpt-4o-mini"
+ANSWER_MODEL = "gpt-4o"
+# Rows of a SQL result passed back to the model
+MAX_RESULT_ROWS = 50
+# Characters of a SQL result, and of a single value in it, passed to the model
+MAX_RESULT_CHARS = 4_000
+MAX_CELL_CHARS = 300
+# Conversation size (in characters) above which older turns are summarized
+MAX_HISTORY_CHARS = 30_000
+# Most recent messages that are always kept verbatim
+KEEP_RECENT_MESSAGES = 6
 
 
 def read_schema(conn):
@@ -20,49 +54,292 @@ def read_schema(conn):
     return cur.fetchall()
 
 
-def execute_sql(conn, query):
-    """Execute a SQL query and return results."""
-    print(f"\n\033[90m[DEBUG] SQL Query:\n{query}\033[0m")
+def normalize_sql(query):
+    """Collapse whitespace outside literals and comments, drop trailing semicolons."""
+    query = re.sub(
+        r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*(?:\n|$))|\s+""",
+        lambda m: m.group(1) or " ",
+        query,
+    )
+    return query.strip().rstrip(";").strip()
+
+
+@lru_cache(maxsize=512)
+def run_query(query):
+    """Run a read-only query; the data does not change, so results are cached.
+
+    Only the first MAX_RESULT_ROWS rows are kept, along with the total count.
+    """
     cur = conn.cursor()
+    cur.execute(query)
+    rows = cur.fetchmany(MAX_RESULT_ROWS)
+    total = len(rows) + sum(1 for _ in cur)
+    return rows, cur.description, total
+
+
+def execute_sql(query):
+    """Execute a SQL query and return its first rows, description and row count."""
+    print(f"\n\033[90m[DEBUG] SQL Query:\n{query}\033[0m")
     try:
-        cur.execute(query)
-        result = cur.fetchall()
-        print(f"\n\033[90m[DEBUG] SQL Result:\n{result}\033[0m")
-        return result
+        rows, description, total = run_query(normalize_sql(query))
+        print(f"\n\033[90m[DEBUG] SQL Result:\n{rows}\033[0m")
+        return rows, description, total
     except Exception as e:
         return f"Error: {e}"
 
 
-def extract_sql(text):
-    """Extract SQL queries from markdown-style blocks."""
-    pattern = r"```sql(.*?)```"
-    return [match.strip() for match in re.findall(pattern, text, re.DOTALL)]
+class SqlBlockParser:
+    """Find ```sql blocks in a streamed reply, looking at each character once."""
 
+    FINAL_MARKER = "FINAL ANSWER:"
 
-def call_gpt(messages):
-    """Call GPT-4o to generate a response based on conversation history."""
-    response = client.chat.completions.create(model="gpt-4o", messages=messages)
-    return response.choices[0].message.content
+    def __init__(self):
+        self.in_fence = False
+        self.current_block = []
+        self.blocks = []
+        # Last few characters of the stream, in case a fence is split
+        self.tail = ""
+        # Start of the reply until it is known whether it is a final answer
+        self.head = ""
+        self.final = None
 
+    def feed(self, text):
+        """Consume the next piece of the reply."""
+        if self.final is None:
+            self.head = (self.head + text).lstrip()
+            if len(self.head) >= len(self.FINAL_MARKER) or not (
+                self.FINAL_MARKER.startswith(self.head)
+            ):
+                self.final = self.head.startswith(self.FINAL_MARKER)
+
+        buffer = self.tail + text
+        while True:
+            if not self.in_fence:
+                start = buffer.find("```sql")
+                if start == -1:
+                    self.tail = buffer[-5:]
+                    return
+                buffer = buffer[start + 6 :]
+                self.in_fence = True
+                self.current_block = []
+            else:
+                end = buffer.find("```")
+                if end == -1:
+                    self.current_block.append(buffer[:-2])
+                    self.tail = buffer[-2:]
+                    return
+                self.current_block.append(buffer[:end])
+                self.blocks.append("".join(self.current_block).strip())
+                buffer = buffer[end + 3 :]
+                self.in_fence = False
+
+
+# Questions answered with canned SQL, without calling the model. Each entry is
+# (pattern, sql_template, formatter); the template is filled in with the
+# pattern's groups, which only match identifiers.
+ROUTES = [
+    (
+        re.compile(r"(?:list|show)(?: all| the)? tables\??", re.IGNORECASE),
+        "SELECT name FROM sqlite_master WHERE type='table' ORDER BY name",
+        lambda rows: "Tables: " + ", ".join(name for (name,) in rows),
+    ),
+    (
+        re.compile(r"(?:describe|show columns of) (?:table )?(\w+)\??", re.IGNORECASE),
+        'PRAGMA table_info("{0}")',
+        lambda rows, table: (
+            f"Columns of {table}: "
+            + ", ".join(f"{row[1]} ({row[2] or 'untyped'})" for row in rows)
+        ),
+    ),
+    (
+        re.compile(r"how many rows (?:are )?in (?:table )?(\w+)\??", re.IGNORECASE),
+        'SELECT COUNT(*) FROM "{0}"',
+        lambda rows, table: f"Table {table} has {rows[0][0]} rows.",
+    ),
+]
+
+
+def route_question(question):
+    """Answer a trivial schema question directly, or return None to ask the model."""
+    for pattern, sql_template, formatter in ROUTES:
+        match = pattern.fullmatch(question.strip())
+        if not match:
+            continue
+        result = execute_sql(sql_template.format(*match.groups()))
+        # Let the model deal with unknown tables and other errors
+        if isinstance(result, str) or not result[0]:
+            return None
+        return formatter(result[0], *match.groups())
+    return None
+
+
+def call_gpt(messages, model=EXPLORE_MODEL):
+    """Stream a chat response, stopping early once it contains a SQL block.
+
+    Replies from models other than ANSWER_MODEL also stop as soon as they turn
+    out to be a final answer, which is then left to ANSWER_MODEL.
+
+    Returns the reply, whether it is a final answer and the SQL queries in it.
+    """
+    reply = []
+    parser = SqlBlockParser()
+    with client.chat.completions.create(
+        model=model, messages=messages, stream=True
+    ) as stream:
+        for i, chunk in enumerate(stream):
+            if not chunk.choices:
+                continue
+            text = chunk.choices[0].delta.content or ""
+            reply.append(text)
+            parser.feed(text)
+
+            if i % 20 == 0:
+                print(".", end="", flush=True)
+
+            # A SQL block can be acted on now. Final answers are only kept from
+            # the larger model, so the smaller one is stopped once it starts one.
+            if parser.blocks and not parser.final:
+                break
+            if parser.final and model != ANSWER_MODEL:
+                break
+    return "".join(reply), bool(parser.final), parser.blocks
+
+
+def _format_cell(value):
+    """Render a value for a TSV cell, keeping it on a single short line."""
+    if value is None:
+        return "NULL"
+    # Raw bytes (such as stored embeddings) mean nothing to the model
+    if isinstance(value, bytes):
+        return f"<BLOB {len(value)} bytes>"
+    text = str(value)
+    if len(text) > MAX_CELL_CHARS:
+        text = f"{text[:MAX_CELL_CHARS]}... ({len(text) - MAX_CELL_CHARS} more chars)"
+    return text.replace("\t", "\\t").replace("\n", "\\n")
+
+
+def _format_rows(rows, cols=None, limit=MAX_RESULT_ROWS, total=None):
+    """Render a SQL result as TSV for the model.
+
+    At most `limit` rows are kept, and no more than MAX_RESULT_CHARS characters.
+    `total` is the full row count when `rows` is already truncated.
+    """
+    if total is None:
+        total = len(rows)
+    lines = []
+    size = 0
+    if cols:
+        lines.append("\t".join(col[0] for col in cols))
+        size = len(lines[0])
+    shown = 0
+    for row in rows[:limit]:
+        line = "\t".join(_format_cell(value) for value in row)
+        if shown and size + len(line) > MAX_RESULT_CHARS:
+            break
+        lines.append(line)
+        size += len(line) + 1
+        shown += 1
+    if total > shown:
+        lines.append(f"...{total - shown} more")
+    return "\n".join(lines)
+
+
+def compact_history(messages):
+    """Summarize older messages once the conversation exceeds MAX_HISTORY_CHARS.
+
+    The system message, the question being answered and the last
+    KEEP_RECENT_MESSAGES messages are always kept verbatim.
+    """
+    recent = messages[-KEEP_RECENT_MESSAGES:]
+    older = messages[1:-KEEP_RECENT_MESSAGES]
+    question = next((m for m in reversed(messages) if m["role"] == "user"), None)
+    if any(m is question for m in older):
+        older = [m for m in older if m is not question]
+        recent = [question] + recent
+    # Nothing to gain from re-summarizing just a previous summary
+    if len(older) < 2 or sum(len(m["content"]) for m in messages) <= MAX_HISTORY_CHARS:
+        return messages
+
+    transcript = "\n\n".join(f"{m['role']}: {m['content']}" for m in older)
+    try:
+        response = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {
+                    "role": "system",
+                    "content": "Summarize this conversation between a user and a SQL analysis assistant. "
+                    "Keep the questions asked, the queries that were run and the facts found in their results.",
+                },
+                {"role": "user", "content": transcript},
+            ],
+        )
+    except Exception as e:
+        print(f"\n\033[90m[DEBUG] Could not summarize history: {e}\033[0m")
+        return messages
+
+    summary = {
+        "role": "system",
+        "content": "Summary of the earlier conversation:\n"
+        + response.choices[0].message.content,
+    }
+    # The system message stays first and unchanged to keep the prompt cache warm
+    return [messages[0], summary] + recent
+
+
+def get_schema_info():
+    """Return the schema description, cached on disk per database version."""
+    stat = os.stat(DB_PATH)
+    key = hashlib.sha256(
+        f"{os.path.abspath(DB_PATH)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+    ).hexdigest()[:16]
+    cache_path = os.path.join(SCHEMA_CACHE_DIR, f"schema_{key}.txt")
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        pass
 
-def main():
     schema = read_schema(conn)
     schema_info = "\n".join([f"{name}: {sql}" for name, sql in schema])
+    # The cache is only an optimization; an unwritable cache dir is fine
+    try:
+        os.makedirs(SCHEMA_CACHE_DIR, exist_ok=True)
+        with open(cache_path, "w", encoding="utf-8") as f:
+            f.write(schema_info)
+    except OSError as e:
+        print(f"\n\033[90m[DEBUG] Could not cache schema: {e}\033[0m")
+    return schema_info
 
-    system_message = (
-        "You are a SQL analysis assistant with access to a database of UN speeches."
-        "Your primary task is to answer user questions by first exploring the data through a series of SQL queries."
-        "Before executing any queries, generate a detailed plan outlining your approach—list the necessary steps, including inspecting table names, column distributions, "
-        "and performing fuzzy text searches to match relevant terms even if the input text is imprecise."
-        "During the exploratory phase, use SQL queries (enclosed in markdown code blocks labeled 'sql') to gather evidence from the database. "
-        "Base your reasoning on this evidence and refine your queries iteratively."
-        "Only when you have enough verified evidence, execute the final SQL query to extract the answer."
-        "Once you are confident in your answer, provide the final response in plain text by starting your message with 'FINAL ANSWER:' and do not include any SQL code."
-        "If, after exploring, no answer can be found, clearly inform the user that the data does not support an answer and explain that no evidence was found."
-        "\n\nDatabase schema:\n" + schema_info
-    )
 
-    messages = [{"role": "system", "content": system_message}]
+# Built once at import. The system message stays byte-identical across calls,
+# so OpenAI's automatic prompt caching can reuse this prefix every turn.
+schema_info = get_schema_info()
+
+SYSTEM_MESSAGE = (
+    "You are a SQL analysis assistant with access to a database of UN speeches."
+    "Your primary task is to answer user questions by first exploring the data through a series of SQL queries."
+    "Before executing any queries, generate a detailed plan outlining your approach—list the necessary steps, including inspecting table names, column distributions, "
+    "and performing fuzzy text searches to match relevant terms even if the input text is imprecise."
+    "During the exploratory phase, use SQL queries (enclosed in markdown code blocks labeled 'sql') to gather evidence from the database. "
+    "Base your reasoning on this evidence and refine your queries iteratively."
+    "Only when you have enough verified evidence, execute the final SQL query to extract the answer."
+    "Once you are confident in your answer, provide the final response in plain text by starting your message with 'FINAL ANSWER:' and do not include any SQL code."
+    "If, after exploring, no answer can be found, clearly inform the user that the data does not support an answer and explain that no evidence was found."
+    "\n\nDatabase schema:\n" + schema_info
+)
+
+
+def warm_up_client():
+    """Open a connection to the API so the first question skips the handshake."""
+    try:
+        client.models.list()
+    except Exception as e:
+        print(f"\n\033[90m[DEBUG] Could not warm up API connection: {e}\033[0m")
+
+
+def main():
+    messages = [{"role": "system", "content": SYSTEM_MESSAGE}]
+    warm_up_client()
 
     print("Welcome! Type your question below. Type 'exit' to quit.")
 
@@ -73,6 +350,12 @@ def main():
 
         messages.append({"role": "user", "content": user_input})
 
+        answer = route_question(user_input)
+        if answer is not None:
+            print("\nAssistant:", answer)
+            messages.append({"role": "assistant", "content": f"FINAL ANSWER: {answer}"})
+            continue
+
         total_queries = 0
 
         # Begin an inner loop to let the assistant refine its answer.
@@ -83,12 +366,20 @@ def main():
                 print("\nAssistant: I'm sorry, but I couldn't find an answer.")
                 break
 
-            assistant_reply = call_gpt(messages)
+            messages = compact_history(messages)
+            # The last attempt goes straight to the larger model
+            model = ANSWER_MODEL if total_queries == 5 else EXPLORE_MODEL
+            assistant_reply, is_final, sql_queries = call_gpt(messages, model)
+            if is_final and model != ANSWER_MODEL:
+                # The smaller model is ready to answer; the larger one writes
+                # the answer from the same evidence (or asks for more SQL)
+                assistant_reply, is_final, sql_queries = call_gpt(
+                    messages, ANSWER_MODEL
+                )
             # print("\n[DEBUG] Assistant:", assistant_reply)
-            print(".", end="", flush=True)
 
             # Check if the assistant indicates a final answer.
-            if assistant_reply.strip().startswith("FINAL ANSWER:"):
+            if is_final:
                 final_answer = (
                     assistant_reply.strip().replace("FINAL ANSWER:", "", 1).strip()
                 )
@@ -98,15 +389,20 @@ def main():
                 break
 
             # Otherwise, check if there are any SQL queries in the response.
-            sql_queries = extract_sql(assistant_reply)
             # print("\n[DEBUG] Extracted SQL queries:", sql_queries)
 
             if sql_queries:
-                for query in sql_queries:
-                    result = execute_sql(conn, query)
+                results = [execute_sql(query) for query in sql_queries]
+                for result in results:
+                    # Errors are passed on as is; rows are rendered as TSV
+                    if isinstance(result, str):
+                        content = result
+                    else:
+                        rows, description, total = result
+                        content = _format_rows(rows, description, total=total)
                     # Append SQL execution result as a function call (hidden from user).
                     messages.append(
-                        {"role": "function", "name": "sql", "content": str(result)}
+                        {"role": "function", "name": "sql", "content": content}
                     )
                 # Record the assistant's message and continue prompting.
                 messages.append({"role": "assistant", "content": assistant_reply})
@@ -115,6 +411,7 @@ def main():
                 messages.append({"role": "assistant", "content": assistant_reply})
                 # print("\n[DEBUG] No SQL queries detected; continuing to refine...")
 
+    http_client.close()
     conn.close()
 
 